@@ -1,7 +1,89 @@
+from math import exp, hypot, pi, sqrt
+
 import numpy as np
 
 from mushroom_rl.environments.pybullet_envs.air_hockey.single import AirHockeySingle, PyBulletObservationType
 
+# Normalization of the Gaussian (sigma = 0.1) rewarding the puck x position in the bottom sub problem
+_R_BOTTOM_SIG_COEF = 1. / (sqrt(2. * pi) * 0.1)
+
+
+def _reward_side(puck_x, puck_y, puck_vel_x, puck_vel_y, ee_x, ee_y, ee_end_x, ee_end_y, has_hit, absorbing,
+                 penalty):
+    if absorbing and abs(puck_y) < 0.47:
+        # Large bonus for being slow at the end
+        r = 100. * exp(-2. * hypot(puck_vel_x, puck_vel_y))
+        return r
+
+    # After hit
+    if has_hit:
+        if puck_x < -0.35 and abs(puck_y) < 0.47:
+            r_vel_x = 1. - 10. * (exp(abs(puck_vel_x)) - 1.)
+            r_vel_x = r_vel_x if r_vel_x > 0. else 0.
+
+            dist_ee_des = hypot(ee_x - ee_end_x, ee_y - ee_end_y)
+            r_ee = 0.5 - dist_ee_des
+
+            r = r_vel_x + r_ee + 1.
+        else:
+            r = 0.
+    # Before hit
+    else:
+        dx = puck_x - ee_x
+        dy = puck_y - ee_y
+        dist_ee_puck = hypot(dx, dy)
+        vec_ee_puck_y = dy / dist_ee_puck
+
+        dir_y = 1. if puck_y >= 0. else -1.
+        cos_ang = vec_ee_puck_y * dir_y
+        cos_ang = 0. if cos_ang < 0. else (1. if cos_ang > 1. else cos_ang)
+
+        r = exp(-8. * (dist_ee_puck - 0.08)) * cos_ang * cos_ang
+
+    r -= penalty
+    return r
+
+
+def _reward_bottom(puck_x, puck_y, puck_vel_x, puck_vel_y, ee_x, ee_y, ee_end_x, ee_end_y, has_hit, absorbing,
+                   penalty):
+    if absorbing and puck_x >= -0.6:
+        # Large bonus for being slow at the end
+        r = 100. * exp(-2. * hypot(puck_vel_x, puck_vel_y))
+        return r
+
+    # After hit
+    if has_hit:
+        if -0.6 > puck_x > -0.9 and abs(puck_y) < 0.47:
+            t = (puck_x + 0.75) * 10.
+            r_x = _R_BOTTOM_SIG_COEF * exp(-t * t * 0.5)
+
+            r_y = 2. - abs(puck_vel_y)
+            dist_ee_des = hypot(ee_x - ee_end_x, ee_y - ee_end_y)
+            r_ee = 0.5 * exp(-3. * dist_ee_des)
+            r = r_x + r_y + r_ee + 1.
+        else:
+            r = 0.
+    # Before hit
+    else:
+        dx = puck_x - ee_x
+        dy = puck_y - ee_y
+        dist_ee_puck = hypot(dx, dy)
+        inv_dist = 1. / dist_ee_puck
+        vec_ee_puck_x = dx * inv_dist
+        vec_ee_puck_y = dy * inv_dist
+
+        side_y = 0.8 if puck_y >= 0. else -0.8
+        cos_ang_side = 0.2 * vec_ee_puck_x + side_y * vec_ee_puck_y
+        cos_ang_side = 0. if cos_ang_side < 0. else (1. if cos_ang_side > 1. else cos_ang_side)
+        cos_ang_bottom = -vec_ee_puck_x
+        cos_ang_bottom = 0. if cos_ang_bottom < 0. else (1. if cos_ang_bottom > 1. else cos_ang_bottom)
+        cos_ang = cos_ang_side if cos_ang_side > cos_ang_bottom else cos_ang_bottom
+
+        r = exp(-8. * (dist_ee_puck - 0.08)) * cos_ang * cos_ang
+
+    r -= penalty
+    return r
+
 
 class AirHockeyPrepare(AirHockeySingle):
     """
@@ -25,6 +107,7 @@ class AirHockeyPrepare(AirHockeySingle):
         self.random_init = random_init
         self.action_penalty = action_penalty
         self.sub_problem = sub_problem
+        self._is_side = sub_problem == "side"
 
         self.start_range = None
         if sub_problem == "side":
@@ -32,34 +115,71 @@ class AirHockeyPrepare(AirHockeySingle):
         elif sub_problem == "bottom":
             self.start_range = np.array([[-0.9, -0.8], [0.125, 0.46]])
 
+        self._start_mid = None
+        self._start_low = None
+        self._start_high = None
+        if self.start_range is not None:
+            self._start_mid = self.start_range.mean(axis=1)
+            self._start_low = self.start_range[:, 0].copy()
+            self._start_high = self.start_range[:, 1].copy()
+
         self.desired_point = np.array([-0.6, 0])
-        self.ee_end_pos = [-8.10001913e-01, -1.43459494e-06]
+        self.ee_end_pos = np.array([-8.10001913e-01, -1.43459494e-06])
+        # Components passed to the reward, ee_end_pos is only read here
+        self._ee_end_x, self._ee_end_y = float(self.ee_end_pos[0]), float(self.ee_end_pos[1])
 
         self.has_hit = False
         self.has_bounce = False
         self.puck_pos = None
+        self._cached_puck_pos = None
+
+        # Buffers passed to the simulator when the puck is reset
+        self._puck_pos3 = np.array([0., 0., -0.189])
+        self._identity_quat = (0., 0., 0., 1.0)
+
+        if self._is_side:
+            self._reward_fn = _reward_side
+        else:
+            self._reward_fn = _reward_bottom
 
         super().__init__(gamma=gamma, horizon=horizon, timestep=timestep, n_intermediate_steps=n_intermediate_steps,
                          debug_gui=debug_gui, env_noise=env_noise, obs_noise=obs_noise, obs_delay=obs_delay,
                          torque_control=torque_control, step_action_function=step_action_function,
                          table_boundary_terminate=table_boundary_terminate, number_flags=1)
 
+        # The model structure is fixed after loading, look up the ids used at every step only once
+        self._puck_id = self._model_map['puck']
+        ee_body, ee_link = self._indexer.link_map['planar_robot_1/link_striker_ee']
+        rims = [self._indexer.link_map[rim] for rim in ('t_up_rim_l', 't_up_rim_r', 't_down_rim_l', 't_down_rim_r')]
+
+        # Arguments of the contact queries checked after each simulation step
+        self._ee_contact_args = (self._puck_id, ee_body, -1, ee_link)
+        self._rim_contact_args = [(self._puck_id, rim_body, -1, rim_link) for rim_body, rim_link in rims]
+
+        # Joint resets applied in setup, the initial joint configuration does not change for this task
+        self._reset_tuples = [(model_id, joint_id, self.init_state[i])
+                              for i, (model_id, joint_id, _) in enumerate(self._indexer.action_data)]
+        self._reset_joint_state = self.client.resetJointState
+
     def setup(self, state):
         if self.random_init:
-            puck_pos = np.random.rand(2) * (self.start_range[:, 1] - self.start_range[:, 0]) + self.start_range[:, 0]
-            puck_pos *= [1, [1, -1][np.random.randint(2)]]
+            puck_pos = np.random.uniform(self._start_low, self._start_high)
+            if np.random.rand() < 0.5:
+                puck_pos[1] = -puck_pos[1]
             # Used for data logging in eval
             self.puck_pos = puck_pos
         else:
-            puck_pos = np.mean(self.start_range, axis=1)
+            puck_pos = self._start_mid.copy()
 
         self.desired_point = [puck_pos[0], 0]
+        self._cached_puck_pos = puck_pos
 
-        puck_pos = np.concatenate([puck_pos, [-0.189]])
-        self.client.resetBasePositionAndOrientation(self._model_map['puck'], puck_pos, [0, 0, 0, 1.0])
+        self._puck_pos3[0] = puck_pos[0]
+        self._puck_pos3[1] = puck_pos[1]
+        self.client.resetBasePositionAndOrientation(self._puck_id, self._puck_pos3, self._identity_quat)
 
-        for i, (model_id, joint_id, _) in enumerate(self._indexer.action_data):
-            self.client.resetJointState(model_id, joint_id, self.init_state[i])
+        for model_id, joint_id, joint_pos in self._reset_tuples:
+            self._reset_joint_state(model_id, joint_id, joint_pos)
 
         self.has_hit = False
         self.has_bounce = False
@@ -71,119 +191,43 @@ class AirHockeyPrepare(AirHockeySingle):
         ee_pos = self.get_sim_state(next_state, "planar_robot_1/link_striker_ee",
                                     PyBulletObservationType.LINK_POS)[:2]
 
-        if self.sub_problem == "side":
-            # Large bonus for being slow at the end
-            if absorbing and abs(puck_pos[1]) < 0.47:
-                r = 100 * np.exp(-2 * np.linalg.norm(puck_vel))
-                return r
-
-            # After hit
-            if self.has_hit:
-                if puck_pos[0] < -0.35 and abs(puck_pos[1]) < 0.47:
-                    r_vel_x = max([0, 1 - (10 * (np.exp(abs(puck_vel[0])) - 1))])
-
-                    dist_ee_des = np.linalg.norm(ee_pos - self.ee_end_pos)
-                    r_ee = 0.5 - dist_ee_des
-
-                    r = r_vel_x + r_ee + 1
-                else:
-                    r = 0
-            # Before hit
-            else:
-                dist_ee_puck = np.linalg.norm(puck_pos - ee_pos)
-                vec_ee_puck = (puck_pos - ee_pos) / dist_ee_puck
-
-                cos_ang = np.clip(vec_ee_puck @ np.array([0, np.copysign(1, puck_pos[1])]), 0, 1)
-
-                r = np.exp(-8 * (dist_ee_puck - 0.08)) * cos_ang ** 2
+        # The next state becomes self._state, reuse its puck position in is_absorbing
+        self._cached_puck_pos = puck_pos
 
-        # If init_strat is "bottom"
-        else:
-            if absorbing and puck_pos[0] >= -0.6:
-                r = 100 * np.exp(-2 * np.linalg.norm(puck_vel))
-                return r
-
-            if self.has_hit:
-                if -0.6 > puck_pos[0] > -0.9 and abs(puck_pos[1]) < 0.47:
-                    sig = 0.1
-
-                    r_x = 1. / (np.sqrt(2. * np.pi) * sig) * np.exp(-np.power((puck_pos[0] + 0.75) / sig, 2.) / 2)
-
-                    r_y = 2 - abs(puck_vel[1])
-                    dist_ee_des = np.linalg.norm(ee_pos - self.ee_end_pos)
-                    r_ee = 0.5 * np.exp(-3 * dist_ee_des)
-                    r = r_x + r_y + r_ee + 1
-                else:
-                    r = 0
-
-            else:
-                # Before hit
-
-                dist_ee_puck = np.linalg.norm(puck_pos - ee_pos)
-                vec_ee_puck = (puck_pos - ee_pos) / dist_ee_puck
+        penalty = self.action_penalty * sqrt(np.dot(action, action))
 
-                cos_ang_side = np.clip(vec_ee_puck @ np.array([0.2, np.copysign(0.8, puck_pos[1])]), 0, 1)
-                cos_ang_bottom = np.clip(vec_ee_puck @ np.array([-1, 0]), 0, 1)
-                cos_ang = max([cos_ang_side, cos_ang_bottom])
-
-                r = np.exp(-8 * (dist_ee_puck - 0.08)) * cos_ang ** 2
-
-        r -= self.action_penalty * np.linalg.norm(action)
-        return r
+        return self._reward_fn(puck_pos[0], puck_pos[1], puck_vel[0], puck_vel[1], ee_pos[0], ee_pos[1],
+                               self._ee_end_x, self._ee_end_y, self.has_hit, absorbing, penalty)
 
     def is_absorbing(self, state):
         if super().is_absorbing(state):
             return True
-        if self.sub_problem == "side":
-            if self.has_hit:
-                puck_pos = self.get_sim_state(self._state, "puck", PyBulletObservationType.BODY_POS)[:2]
-                if puck_pos[0] > 0 or abs(puck_pos[1]) < 0.01:
-                    return True
-            return self.has_bounce
-        else:
-            if self.has_hit:
-                puck_pos = self.get_sim_state(self._state, "puck", PyBulletObservationType.BODY_POS)[:2]
-                if puck_pos[0] > 0 or abs(puck_pos[1]) < 0.01:
-                    return True
-            return False
+        if self.has_hit:
+            puck_x, puck_y = self._cached_puck_pos
+            if puck_x > 0 or abs(puck_y) < 0.01:
+                return True
+        return self.has_bounce if self._is_side else False
 
     def _simulation_post_step(self):
+        if self.has_hit and self.has_bounce:
+            return
+
         if not self.has_hit:
-            collision_count = len(self.client.getContactPoints(self._model_map['puck'],
-                                                               self._indexer.link_map['planar_robot_1/'
-                                                                                      'link_striker_ee'][0],
-                                                               -1,
-                                                               self._indexer.link_map['planar_robot_1/'
-                                                                                      'link_striker_ee'][1]))
-            if collision_count > 0:
+            if self.client.getContactPoints(*self._ee_contact_args):
                 self.has_hit = True
 
         if not self.has_bounce:
-            collision_count = 0
-            collision_count += len(self.client.getContactPoints(self._model_map['puck'],
-                                                                self._indexer.link_map['t_up_rim_l'][0],
-                                                                -1,
-                                                                self._indexer.link_map['t_up_rim_l'][1]))
-            collision_count += len(self.client.getContactPoints(self._model_map['puck'],
-                                                                self._indexer.link_map['t_up_rim_r'][0],
-                                                                -1,
-                                                                self._indexer.link_map['t_up_rim_r'][1]))
-
-            collision_count += len(self.client.getContactPoints(self._model_map['puck'],
-                                                                self._indexer.link_map['t_down_rim_l'][0],
-                                                                -1,
-                                                                self._indexer.link_map['t_down_rim_l'][1]))
-            collision_count += len(self.client.getContactPoints(self._model_map['puck'],
-                                                                self._indexer.link_map['t_down_rim_r'][0],
-                                                                -1,
-                                                                self._indexer.link_map['t_down_rim_r'][1]))
-
-            if collision_count > 0:
-                self.has_bounce = True
+            for rim_contact_args in self._rim_contact_args:
+                if self.client.getContactPoints(*rim_contact_args):
+                    self.has_bounce = True
+                    return
 
     def _create_observation(self, state):
         obs = super(AirHockeyPrepare, self)._create_observation(state)
-        return np.append(obs, [self.has_hit])
+        out = np.empty(obs.size + 1, dtype=obs.dtype)
+        out[:-1] = obs
+        out[-1] = self.has_hit
+        return out
 
 
 if __name__ == '__main__':
@@ -54,6 +54,30 @@ try:
         assert np.allclose(obs, obs_test)
 
 
+    def test_prepare_reward():
+        from mushroom_rl.environments.pybullet_envs.air_hockey.prepare import _reward_side, _reward_bottom
+
+        ee_end = (-8.10001913e-01, -1.43459494e-06)
+        penalty = 1e-3 * np.linalg.norm(np.array([1] * 3))
+
+        # puck_pos, puck_vel, ee_pos, has_hit, absorbing, expected reward
+        side_cases = [((-0.5, 0.2), (0.3, -0.4), (-0.8, 0.), False, True, 36.787944117144235),
+                      ((-0.5, 0.2), (0.05, 0.1), (-0.7, 0.05), True, False, 1.8647241905244678),
+                      ((-0.2, 0.2), (0.05, 0.1), (-0.7, 0.05), True, False, -0.0017320508075688772),
+                      ((-0.5, 0.3), (0., 0.), (-0.6, 0.1), False, False, 0.251867726811963),
+                      ((-0.5, -0.3), (0., 0.), (-0.6, -0.1), False, False, 0.251867726811963)]
+        bottom_cases = [((-0.5, 0.2), (0.3, -0.4), (-0.8, 0.), False, True, 36.787944117144235),
+                        ((-0.7, 0.1), (0.1, -0.2), (-0.75, 0.02), True, False, 6.732506869355957),
+                        ((-0.95, 0.1), (0.1, -0.2), (-0.75, 0.02), True, False, -0.0017320508075688772),
+                        ((-0.85, 0.3), (0., 0.), (-0.7, 0.2), False, False, 0.3086518710012715),
+                        ((-0.85, -0.3), (0., 0.), (-0.9, -0.1), False, False, 0.24612459747529059)]
+
+        for reward_fn, cases in [(_reward_side, side_cases), (_reward_bottom, bottom_cases)]:
+            for puck_pos, puck_vel, ee_pos, has_hit, absorbing, r_test in cases:
+                r = reward_fn(*puck_pos, *puck_vel, *ee_pos, *ee_end, has_hit, absorbing, penalty)
+                assert np.isclose(r, r_test)
+
+
     def test_repel():
         obs = []
         mdp = AirHockeyRepel()